@@ -1,19 +1,65 @@
-from anthropic import Anthropic
-import json
-from typing import List, TypedDict, Any
+from anthropic import AsyncAnthropic
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import orjson
+from typing import List, Dict, Tuple, TypedDict, Any, Awaitable, Callable, Iterator
+from functools import wraps
+import hashlib
 import re
 import os
-from docx import Document
-from docx.oxml.ns import qn
+import sqlite3
+import threading
+import zlib
+import numpy as np
 from pdf2docx import Converter
-import tempfile
-from bs4 import BeautifulSoup
+import zipfile
+import posixpath
+from lxml import etree
+import lxml.html
+from lxml.html import HtmlElement
+from copy import deepcopy
+from itertools import chain
 from shared.const import API_BASE
 import html
-import time
-import requests
-
-client = Anthropic(api_key=os.environ['ANTHROPIC_KEY'])
+import io
+import httpx
+
+client = AsyncAnthropic(api_key=os.environ['ANTHROPIC_KEY'])
+
+DOCUMENT_SUFFIXES = {'docx', 'pdf'}
+
+MAX_CONCURRENT_REQUESTS = 16
+# Documents extracted, parsed and indexed at once; keeps memory bounded when extraction outpaces the API
+MAX_IN_FLIGHT_DOCUMENTS = 2 * MAX_CONCURRENT_REQUESTS
+MAX_RETRIES = 2
+# Roughly 8k tokens per request at ~4 characters per token
+CHUNK_CHARS = 32_000
+CHUNK_OVERLAP_CHARS = 2_000
+
+MAX_UPLOAD_CONNECTIONS = 32
+UPLOAD_TIMEOUT = 30
+
+CARD_CACHE_PATH = os.environ.get('CARD_CACHE_PATH', 'data/card_cache.sqlite')
+EMBEDDING_DIM = 4096
+SHINGLE_SIZE = 3
+SIMILARITY_THRESHOLD = 0.92
+# Share of a similar document's cached cards that must be found in a new one before they're reused
+CACHE_MATCH_FRACTION = 0.8
+
+# Upper bound on the (target, element) tally held in memory at once while matching cards
+MATCH_BLOCK_CELLS = 1 << 22
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_BODY, W_P, W_TBL, W_SDT = f'{W}body', f'{W}p', f'{W}tbl', f'{W}sdt'
+W_R, W_HYPERLINK, W_RPR = f'{W}r', f'{W}hyperlink', f'{W}rPr'
+W_B, W_I, W_U, W_HIGHLIGHT, W_COLOR = f'{W}b', f'{W}i', f'{W}u', f'{W}highlight', f'{W}color'
+W_T, W_TAB, W_PTAB, W_BR, W_CR, W_NO_BREAK_HYPHEN = f'{W}t', f'{W}tab', f'{W}ptab', f'{W}br', f'{W}cr', f'{W}noBreakHyphen'
+W_VAL, W_TYPE = f'{W}val', f'{W}type'
+R_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+OFFICE_DOCUMENT_RELATIONSHIP = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+URL_PATTERN = re.compile(r'https?://\S+')
+AUTHOR_XPATH = etree.XPath('.//text()[contains(., $author)]')
 
 class Card(TypedDict):
     author: str
@@ -23,68 +69,226 @@ class Card(TypedDict):
 class CardWithHTML(TypedDict):
     author: str
     url: str
-    html_content: str
+    content: HtmlElement
+
+class CardUpload(TypedDict):
+    html: str
+    text: str
+    author: str
+    url: str
 
 class MetadataEntry(TypedDict):
     author: str
     url: str
 
+def on_off(elem: etree._Element | None) -> bool:
+    """Read a WordprocessingML on/off property, which is on when present unless turned off explicitly."""
+    return elem is not None and elem.get(W_VAL) not in ('0', 'false', 'off')
+
+def run_text(run: etree._Element) -> str:
+    """Get a run's text the way python-docx does, including tabs and line breaks."""
+    text: List[str] = []
+    for child in run:
+        if child.tag == W_T:
+            text.append(child.text or '')
+        elif child.tag in (W_TAB, W_PTAB):
+            text.append('\t')
+        elif child.tag == W_CR or (child.tag == W_BR and child.get(W_TYPE) in (None, 'textWrapping')):
+            text.append('\n')
+        elif child.tag == W_NO_BREAK_HYPHEN:
+            text.append('-')
+
+    return ''.join(text)
+
+def run_formatting(run: etree._Element, href: str | None) -> List[Tuple[str, str]]:
+    """Get the (open, close) tags for a run's formatting, from outermost to innermost."""
+    rPr = run.find(W_RPR)
+    tags: List[Tuple[str, str]] = []
+
+    if href:
+        tags.append((f'<a href="{html.escape(href)}">', '</a>'))
+
+    if rPr is not None:
+        color = rPr.find(W_COLOR)
+        if color is not None and color.get(W_VAL) not in (None, 'auto'):
+            rgb = bytes.fromhex(color.get(W_VAL))
+            tags.append((f'<span style="color: rgb({rgb[0]},{rgb[1]},{rgb[2]});">', '</span>'))
+
+        highlight = rPr.find(W_HIGHLIGHT)
+        if highlight is not None and highlight.get(W_VAL) not in (None, 'none'):
+            tags.append((f'<mark style="background-color: {highlight.get(W_VAL)};">', '</mark>'))
+
+        underline = rPr.find(W_U)
+        if underline is not None and underline.get(W_VAL) not in (None, 'none'):
+            tags.append(('<u>', '</u>'))
+
+        if on_off(rPr.find(W_I)):
+            tags.append(('<em>', '</em>'))
+        if on_off(rPr.find(W_B)):
+            tags.append(('<strong>', '</strong>'))
+
+    return tags
+
+def write_paragraph(html_content: io.StringIO, paragraph: etree._Element, hyperlinks: Dict[str, str]) -> None:
+    """Write a paragraph's runs, extending tags across adjacent runs instead of reopening them per run."""
+    runs: List[Tuple[etree._Element, str | None]] = []
+    for child in paragraph:
+        if child.tag == W_R:
+            runs.append((child, None))
+        elif child.tag == W_HYPERLINK:
+            href = hyperlinks.get(child.get(R_ID))
+            runs.extend((run, href) for run in child.iterchildren(W_R))
+
+    html_content.write('<p>')
+    open_tags: List[Tuple[str, str]] = []
+
+    for run, href in runs:
+        text = run_text(run)
+        if not text:
+            continue
+
+        # Keep every tag the previous run already opened that this run also starts with
+        tags = run_formatting(run, href)
+        shared = 0
+        while shared < min(len(tags), len(open_tags)) and tags[shared] == open_tags[shared]:
+            shared += 1
+
+        for _, close_tag in reversed(open_tags[shared:]):
+            html_content.write(close_tag)
+        for open_tag, _ in tags[shared:]:
+            html_content.write(open_tag)
+        html_content.write(html.escape(text))
+        open_tags = tags
+
+    for _, close_tag in reversed(open_tags):
+        html_content.write(close_tag)
+    html_content.write('</p>')
+
+def read_relationships(docx: zipfile.ZipFile, part: str) -> Dict[str, str]:
+    """Map a docx part's relationship IDs to their targets."""
+    directory, name = posixpath.split(part)
+    rels_path = posixpath.join(directory, '_rels', f'{name}.rels')
+    if rels_path not in docx.namelist():
+        return {}
+
+    rels = etree.fromstring(docx.read(rels_path))
+    return {rel.get('Id'): rel.get('Target') for rel in rels}
+
 def extract_formatted_text(file_path: str) -> str:
     """Extract formatted text from Word document, preserving highlighting and structure."""
-    doc = Document(file_path if file_path.endswith(".docx") else convert_pdf_to_docx(file_path))
-    html_content: List[str] = []
-
-    for paragraph in doc.paragraphs:
-        para_html: List[str] = []
-        for run in paragraph.runs:
-            text = html.escape(run.text)
-            if run.bold:
-                text = f'<strong>{text}</strong>'
-            if run.italic:
-                text = f'<em>{text}</em>'
-            if run.underline:
-                text = f'<u>{text}</u>'
-            if run.font.highlight_color:
-                highlight_color = run.font.highlight_color
-                text = f'<mark style="background-color: {highlight_color};">{text}</mark>'
-            if run.font.color.rgb:
-                color = run.font.color.rgb
-                text = f'<span style="color: rgb({color[0]},{color[1]},{color[2]});">{text}</span>'
-
-            # Check for hyperlinks
-            if run._element.rPr is not None:
-                if run._element.rPr.xpath("./w:rStyle[@w:val='Hyperlink']"):
-                    for link in run._element.xpath(".//w:hyperlink"):
-                        if link.get(qn("r:id")):
-                            href = doc.part.rels[link.get(qn("r:id"))].target_ref
-                            text = f'<a href="{href}">{text}</a>'
-
-            para_html.append(text)
-
-        html_content.append(f'<p>{"".join(para_html)}</p>')
-
-    return '\n'.join(html_content)
-
-def convert_pdf_to_docx(pdf_path: str) -> str:
-    """Convert PDF to DOCX and return the path to the new file"""
-    # Create a temporary file with .docx extension
-    with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as tmp_file:
-        docx_path = tmp_file.name
+    docx_file = file_path if file_path.lower().endswith(".docx") else convert_pdf_to_docx(file_path)
+    html_content = io.StringIO()
+
+    with zipfile.ZipFile(docx_file) as docx:
+        package_rels = etree.fromstring(docx.read('_rels/.rels'))
+        document_part = next(
+            rel.get('Target').lstrip('/') for rel in package_rels
+            if rel.get('Type') == OFFICE_DOCUMENT_RELATIONSHIP
+        )
+        hyperlinks = read_relationships(docx, document_part)
+
+        with docx.open(document_part) as document:
+            first = True
+            # Only top-level body elements are kept in memory, and each is dropped as soon as it's read
+            for _, elem in etree.iterparse(document, events=('end',), tag=(W_P, W_TBL, W_SDT)):
+                body = elem.getparent()
+                if body is None or body.tag != W_BODY:
+                    continue
+
+                # Like python-docx, only paragraphs directly in the body are extracted
+                if elem.tag == W_P:
+                    if not first:
+                        html_content.write('\n')
+                    first = False
+                    write_paragraph(html_content, elem, hyperlinks)
+
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del body[0]
+
+    return html_content.getvalue()
+
+def convert_pdf_to_docx(pdf_path: str) -> io.BytesIO:
+    """Convert PDF to DOCX in memory and return the new file"""
+    docx_file = io.BytesIO()
 
     # Convert PDF to DOCX
     cv = Converter(pdf_path)
-    cv.convert(docx_path)
-    cv.close()
-
-    return docx_path
-
-def flexible_match(target: str, text: str, threshold: float = 0.8) -> bool:
-    """Perform a flexible match between target and text."""
-    target_words = target.lower().split()
-    text_words = text.lower().split()
-
-    matches = sum(1 for word in target_words if word in text_words)
-    return matches / len(target_words) >= threshold
+    try:
+        cv.convert(docx_file)
+    finally:
+        cv.close()
+
+    docx_file.seek(0)
+    return docx_file
+
+def fingerprint_words(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash every lowercased word of every text to an int64, along with the index of the text it came from."""
+    words = [text.lower().split() for text in texts]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    fingerprints = np.fromiter(map(hash, chain.from_iterable(words)), dtype=np.int64, count=int(lengths.sum()))
+
+    return fingerprints, np.repeat(np.arange(len(texts)), lengths)
+
+def unique_pairs(high: np.ndarray, low: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sort (high, low) pairs, returning each distinct pair once with how many times it appeared."""
+    if not len(high):
+        return high, low, np.zeros(0, dtype=np.int64)
+
+    order = np.lexsort((low, high))
+    high, low = high[order], low[order]
+    starts = np.flatnonzero(np.r_[True, (high[1:] != high[:-1]) | (low[1:] != low[:-1])])
+
+    return high[starts], low[starts], np.diff(np.r_[starts, len(high)])
+
+class ParagraphIndex:
+    """Inverted index from word fingerprints to the elements of a document that contain them."""
+
+    def __init__(self, tree: HtmlElement):
+        self.elems: List[HtmlElement] = list(tree.iter('p', 'div', 'span'))
+        self.texts: List[str] = [elem.text_content() for elem in self.elems]
+        self.positions: Dict[HtmlElement, int] = {elem: i for i, elem in enumerate(self.elems)}
+
+        # One (fingerprint, element) posting per distinct word in each element, sorted by fingerprint then element
+        fingerprints, elems = fingerprint_words(self.texts)
+        self.fingerprints, self.posting_elems, _ = unique_pairs(fingerprints, elems)
+
+    def text(self, elem: HtmlElement) -> str:
+        """Get an element's text, reusing the copy read while indexing."""
+        i = self.positions.get(elem)
+        return self.texts[i] if i is not None else elem.text_content()
+
+    def match(self, targets: List[str], threshold: float = 0.8) -> np.ndarray:
+        """Find every (target, element) pair where the element contains enough of the target's words.
+
+        Pairs are returned as sorted `target * len(elems) + element` keys.
+        """
+        # Each distinct word of each target, with how many times the target uses it, in target order
+        fingerprints, owners = fingerprint_words(targets)
+        lengths = np.bincount(owners, minlength=len(targets))
+        target_owners, target_fingerprints, word_counts = unique_pairs(owners, fingerprints)
+
+        # Join every target word against its postings
+        lo = np.searchsorted(self.fingerprints, target_fingerprints, side='left')
+        hits = np.searchsorted(self.fingerprints, target_fingerprints, side='right') - lo
+        offsets = np.arange(hits.sum()) - np.repeat(np.cumsum(hits) - hits, hits)
+        rows = self.posting_elems[np.repeat(lo, hits) + offsets]
+        cols = np.repeat(target_owners, hits)
+        weights = np.repeat(word_counts, hits)
+
+        # Sum the words each target shares with each element, a bounded block of targets at a time
+        rows_per_target = max(len(self.elems), 1)
+        block_size = max(MATCH_BLOCK_CELLS // rows_per_target, 1)
+        keys: List[np.ndarray] = []
+        for block_start in range(0, len(targets), block_size):
+            block_end = min(block_start + block_size, len(targets))
+            first, last = np.searchsorted(cols, [block_start, block_end])
+            block_keys = (cols[first:last] - block_start) * rows_per_target + rows[first:last]
+            matches = np.bincount(block_keys, weights=weights[first:last], minlength=(block_end - block_start) * rows_per_target)
+            needed = np.repeat(threshold * lengths[block_start:block_end], rows_per_target)
+            keys.append(np.flatnonzero(matches >= needed) + block_start * rows_per_target)
+
+        return np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
 
 def validate_and_clean_cards(cards_data: Any) -> List[Card]:
     """Clean and validate the extracted cards."""
@@ -108,15 +312,9 @@ def validate_and_clean_cards(cards_data: Any) -> List[Card]:
 
     return cleaned_cards
 
-def identify_card_boundaries(html_content: str) -> List[Card]:
-    """Use Anthropic API to identify card boundaries in HTML content."""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    text = soup.get_text()
-
-    print(f"Extracted text length: {len(text)} characters")
-    print("Sending request to Anthropic API...")
-
-    prompt = f"""Human: Analyze the following text and identify each distinct evidence card. For each card, extract:
+def build_prompt(text: str) -> str:
+    """Build the card boundary prompt for the given document text."""
+    return f"""Human: Analyze the following text and identify each distinct evidence card. For each card, extract:
 1. The author's name and year (e.g., "Massey '17")
 2. The exact start of the card content WHICH INCLUDES THE AUTHOR NAME
 3. The exact end of the card content
@@ -144,86 +342,358 @@ Here's the text to analyze:
 {text}
 """
 
-    response_content = client.messages.create(
-        max_tokens=4000,
-        messages=[{
-            "role": "user",
-            "content": prompt + "\n\nText to analyze:\n" + text
-        }],
-        model="claude-3-5-sonnet-20241022",
-        stream=False
-    ).content[0].text
-
-    match = re.search(r'\[\s*\{.*?\}\s*\]', response_content, re.DOTALL)
-    if match:
-        json_str = match.group(0)
-        try:
-            cards_data = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"JSON decoding error: {e}")
-            return []
+def chunk_text(text: str) -> List[str]:
+    """Split text on paragraph boundaries into overlapping chunks of at most CHUNK_CHARS."""
+    chunks: List[str] = []
+    chunk: List[str] = []
+    chunk_length = 0
+
+    for paragraph in text.split('\n'):
+        if chunk and chunk_length + len(paragraph) > CHUNK_CHARS:
+            # Carry trailing paragraphs over so cards split across the boundary appear whole in one chunk
+            overlap: List[str] = []
+            overlap_length = 0
+            for previous in reversed(chunk):
+                if overlap_length + len(previous) > CHUNK_OVERLAP_CHARS:
+                    break
+                overlap.insert(0, previous)
+                overlap_length += len(previous) + 1
+
+            # A chunk that would be carried over whole is sent again with the next one, so keep growing it instead
+            if len(overlap) < len(chunk):
+                chunks.append('\n'.join(chunk))
+                chunk, chunk_length = overlap, overlap_length
+
+        chunk.append(paragraph)
+        chunk_length += len(paragraph) + 1
+
+    chunks.append('\n'.join(chunk))
+    return chunks
+
+class CardArrayScanner:
+    """Incrementally pull the objects out of the first JSON array of objects in a streamed response.
+
+    Every character is looked at once, tracking bracket depth and string state, so the scan is linear however the
+    response is chunked. Text before the array and anything after its closing bracket is ignored. An empty array also
+    counts as found, so a response with no cards can be told apart from one with no array at all.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.opening = False
+        self.found = False
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+        self.in_object = False
+        self.pending = ''
+
+    def feed(self, text: str) -> List[Any]:
+        """Scan the next chunk of the response, returning any objects it completes."""
+        objects: List[Any] = []
+        start = 0 if self.in_object else None
+
+        for i, char in enumerate(text):
+            if self.done:
+                break
+
+            if self.depth == 0:
+                if char == '[':
+                    self.depth = 1
+                    self.opening = True
+                continue
+
+            if self.opening:
+                # Like the old `\[\s*\{` pattern, only an array that starts with an object counts
+                if char.isspace():
+                    continue
+                self.opening = False
+                if char == ']':
+                    self.found = True
+                    self.done = True
+                    continue
+                if char != '{':
+                    self.depth = 0
+                    if char == '[':
+                        self.depth = 1
+                        self.opening = True
+                    continue
+                self.found = True
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '[{':
+                self.depth += 1
+                if self.depth == 2 and char == '{':
+                    self.in_object = True
+                    start = i
+            elif char in ']}':
+                self.depth -= 1
+                if self.depth == 1 and self.in_object:
+                    object_text = self.pending + text[start:i + 1]
+                    self.in_object = False
+                    self.pending = ''
+                    start = None
+                    try:
+                        objects.append(orjson.loads(object_text))
+                    except orjson.JSONDecodeError as e:
+                        print(f"JSON decoding error: {e}")
+                elif self.depth == 0:
+                    self.done = True
+
+        if self.in_object and start is not None:
+            self.pending += text[start:]
+
+        return objects
+
+async def submit(prompt: str, semaphore: asyncio.Semaphore) -> List[Card]:
+    """Stream a prompt's response from the Anthropic API, retrying on responses without a card array."""
+    for attempt in range(MAX_RETRIES + 1):
+        cards_data: List[Any] = []
+        scanner = CardArrayScanner()
+
+        async with semaphore:
+            async with client.messages.stream(
+                max_tokens=4000,
+                messages=[{
+                    "role": "user",
+                    "content": prompt
+                }],
+                model="claude-3-5-sonnet-20241022"
+            ) as stream:
+                # Parse cards as they arrive, so a response cut off at max_tokens still keeps every complete card
+                async for text in stream.text_stream:
+                    cards_data.extend(scanner.feed(text))
+                    # Stop reading once the array is closed; anything after it isn't cards
+                    if scanner.done:
+                        break
+
         cleaned_cards = validate_and_clean_cards(cards_data)
-        if cleaned_cards:
+        # A complete but empty array is a valid answer for text without cards, so don't ask again
+        if cleaned_cards or (scanner.found and scanner.done):
             return cleaned_cards
 
-    print("Invalid or empty response from Anthropic. Retrying...")
-    time.sleep(1)  # Wait a second before retrying
+        if attempt < MAX_RETRIES:
+            print("Invalid or empty response from Anthropic. Retrying...")
+            await asyncio.sleep(1)  # Wait a second before retrying
 
     return []
 
-def extract_card_html(html_content: str, cards: List[Card]) -> List[CardWithHTML]:
+def normalize_text(text: str) -> str:
+    """Collapse case and whitespace so re-cut copies of a file hash identically."""
+    return ' '.join(text.lower().split())
+
+def embed_text(normalized: str) -> np.ndarray:
+    """Embed text as an L2-normalized vector of signed, hashed word shingles."""
+    words = normalized.split()
+    shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))]
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode()) for shingle in shingles),
+        dtype=np.int64,
+        count=len(shingles)
+    )
+    # The high bit picks each shingle's sign, so unrelated shingles sharing a bucket cancel out instead of adding up
+    # and long unrelated documents don't drift towards each other
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0)
+    embedding = np.bincount(hashes % EMBEDDING_DIM, weights=signs, minlength=EMBEDDING_DIM).astype(np.float32)
+    norm = np.linalg.norm(embedding)
+
+    return embedding / norm if norm else embedding
+
+def document_key(text: str) -> Tuple[str, np.ndarray]:
+    """Hash and embed a document's text for looking it up in the card cache."""
+    normalized = normalize_text(text)
+    return hashlib.sha256(normalized.encode()).hexdigest(), embed_text(normalized)
+
+def cards_found(index: ParagraphIndex, cards: List[Card]) -> bool:
+    """Check that most cards' start text can be found in a document."""
+    matches = index.match([html.unescape(card['start']) for card in cards])
+    found = len(np.unique(matches // max(len(index.elems), 1)))
+
+    return found >= CACHE_MATCH_FRACTION * len(cards)
+
+class CardCache:
+    """Cards previously identified for a document, looked up by exact hash or embedding similarity."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Used from worker threads, one at a time under the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS cards (hash TEXT PRIMARY KEY, embedding BLOB, cards TEXT)")
+
+        rows = self.db.execute("SELECT embedding, cards FROM cards").fetchall()
+        self.cards: List[str] = [row[1] for row in rows]
+        # Rows past len(self.cards) are spare capacity, doubled when full so inserts don't copy every row
+        self.embeddings = np.zeros((max(len(rows), 1), EMBEDDING_DIM), dtype=np.float32)
+        for i, row in enumerate(rows):
+            self.embeddings[i] = np.frombuffer(row[0], dtype=np.float32)
+
+    def get(self, digest: str) -> List[Card] | None:
+        with self.lock:
+            row = self.db.execute("SELECT cards FROM cards WHERE hash = ?", (digest,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def get_similar(self, embedding: np.ndarray) -> List[Card] | None:
+        with self.lock:
+            if not self.cards:
+                return None
+
+            similarities = self.embeddings[:len(self.cards)] @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < SIMILARITY_THRESHOLD:
+                return None
+            cards_json = self.cards[best]
+
+        return orjson.loads(cards_json)
+
+    def put(self, digest: str, embedding: np.ndarray, cards: List[Card]) -> None:
+        cards_json = orjson.dumps(cards).decode()
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cards VALUES (?, ?, ?)", (digest, embedding.tobytes(), cards_json))
+            self.db.commit()
+
+            if len(self.cards) == len(self.embeddings):
+                grown = np.zeros((2 * len(self.embeddings), EMBEDDING_DIM), dtype=np.float32)
+                grown[:len(self.cards)] = self.embeddings
+                self.embeddings = grown
+            self.embeddings[len(self.cards)] = embedding
+            self.cards.append(cards_json)
+
+card_cache: CardCache | None = None
+
+# Documents share one output directory, so their threads take turns writing to it
+output_lock = threading.Lock()
+
+def cache_cards(identify: Callable[..., Awaitable[List[Card]]]) -> Callable[..., Awaitable[List[Card]]]:
+    """Skip the Anthropic API call for documents whose text has already been seen.
+
+    The wrapped function takes the document's `index` as an extra keyword argument, used to check cards cached for a
+    similar document before reusing them.
+    """
+    @wraps(identify)
+    async def wrapper(text: str, *args, index: Awaitable[ParagraphIndex], **kwargs) -> List[Card]:
+        global card_cache
+        if card_cache is None:
+            card_cache = CardCache(CARD_CACHE_PATH)
+
+        # Embedding, similarity search and sqlite all block, so keep them off the event loop
+        digest, embedding = await asyncio.to_thread(document_key, text)
+        cached_cards = await asyncio.to_thread(card_cache.get, digest)
+        if cached_cards is None:
+            similar_cards = await asyncio.to_thread(card_cache.get_similar, embedding)
+            # Similar text can still hold different cards, so only reuse cards that are actually in this document
+            if similar_cards is not None and await asyncio.to_thread(cards_found, await index, similar_cards):
+                cached_cards = similar_cards
+
+        if cached_cards is not None:
+            print(f"Using {len(cached_cards)} cached cards")
+            return cached_cards
+
+        cards = await identify(text, *args, **kwargs)
+        # Don't cache failed extractions so they get retried next run
+        if cards:
+            await asyncio.to_thread(card_cache.put, digest, embedding, cards)
+
+        return cards
+
+    return wrapper
+
+@cache_cards
+async def identify_card_boundaries(text: str, semaphore: asyncio.Semaphore) -> List[Card]:
+    """Use Anthropic API to identify card boundaries in a document's text."""
+    chunks = chunk_text(text)
+    print(f"Extracted text length: {len(text)} characters")
+    print(f"Sending {len(chunks)} requests to Anthropic API...")
+
+    chunk_cards = await asyncio.gather(*[submit(build_prompt(chunk), semaphore) for chunk in chunks])
+
+    # Overlapping chunks report the same cards more than once. A repeated card starts in the overlap, where the
+    # earlier chunk may cut it off, so keep its place in document order but take the later chunk's copy
+    cards: Dict[Tuple[str, str], Card] = {}
+    for card in (card for chunk in chunk_cards for card in chunk):
+        cards[(card['author'], card['start'][:80])] = card
+
+    return list(cards.values())
+
+def parse_html(html_content: str) -> HtmlElement:
+    """Parse extracted HTML content into a single tree rooted at <body>."""
+    return lxml.html.fragment_fromstring(html_content, create_parent='body')
+
+def inner_html(elem: HtmlElement) -> str:
+    """Serialize an element's children without the element itself."""
+    return (html.escape(elem.text) if elem.text else '') + ''.join(
+        lxml.html.tostring(child, encoding='unicode') for child in elem
+    )
+
+def first_matches(keys: np.ndarray, rows: int, targets: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Find each target's first matching row at or after its start row, or -1 if there is none."""
+    if not len(keys):
+        return np.full(len(targets), -1, dtype=np.int64)
+
+    # Searches that run past a target's last match land on another target (or before the start, when clipped)
+    found = np.minimum(np.searchsorted(keys, targets * rows + starts), len(keys) - 1)
+    match_targets, match_rows = np.divmod(keys[found], rows)
+
+    return np.where((match_targets == targets) & (match_rows >= starts), match_rows, -1)
+
+def extract_card_html(index: ParagraphIndex, cards: List[Card]) -> List[CardWithHTML]:
     """Extract HTML content for each card."""
     cards_with_html: List[CardWithHTML] = []
-    soup = BeautifulSoup(html_content, 'html.parser')
 
-    for card in cards:
-        try:
-            start_text = html.unescape(card['start'])
-            end_text = html.unescape(card['end'])
-
-            # Find the start element
-            start_elem = None
-            for elem in soup.find_all(['p', 'div', 'span']):
-                if flexible_match(start_text, elem.get_text()):
-                    start_elem = elem
-                    break
+    # Match every card's start and end against the whole document in one pass
+    start_texts = [html.unescape(card['start']) for card in cards]
+    end_texts = [html.unescape(card['end']) for card in cards]
+    matches = index.match(start_texts + end_texts)
+    targets = np.arange(len(cards))
 
-            if not start_elem:
+    # Find every start element, then every end element from its start element onwards in document order
+    start_idxs = first_matches(matches, len(index.elems), targets, np.zeros(len(cards), dtype=np.int64))
+    end_idxs = first_matches(matches, len(index.elems), targets + len(cards), np.maximum(start_idxs, 0))
+
+    for i, card in enumerate(cards):
+        try:
+            start_idx, end_idx = int(start_idxs[i]), int(end_idxs[i])
+            if start_idx == -1:
                 print(f"Couldn't find start for card: {card['author']}")
                 continue
 
-            # Find the end element
-            end_elem = None
-            current = start_elem
-            while current:
-                if flexible_match(end_text, current.get_text()):
-                    end_elem = current
-                    break
-                current = current.next_element
-
-            if not end_elem:
+            if end_idx == -1:
                 print(f"Couldn't find end for card: {card['author']}")
                 continue
 
-            # Extract all HTML content between start and end elements
-            full_content = []
+            # Stop at whichever sibling of the start element contains the end element
+            start_elem = index.elems[start_idx]
+            stop_elem = index.elems[end_idx]
+            while stop_elem is not None and stop_elem.getparent() is not start_elem.getparent():
+                stop_elem = stop_elem.getparent()
+
+            # Copy all elements between start and end elements, taking the first URL in their text
+            content = lxml.html.Element('div')
+            url = ''
             current = start_elem
-            while current:
-                full_content.append(str(current))
-                if current == end_elem:
+            while current is not None:
+                content.append(deepcopy(current))
+                if not url:
+                    url_match = URL_PATTERN.search(index.text(current))
+                    url = url_match.group(0) if url_match else ''
+                if current is stop_elem:
                     break
-                current = current.next_sibling
-
-            full_html = ''.join(full_content)
-
-            # Extract URL
-            url_match = re.search(r'https?://\S+', full_html)
-            url = url_match.group(0) if url_match else ''
+                current = current.getnext()
+            content[-1].tail = None
 
             cards_with_html.append({
                 'author': card['author'],
                 'url': url,
-                'html_content': full_html
+                'content': content
             })
 
         except Exception as e:
@@ -233,38 +703,34 @@ def extract_card_html(html_content: str, cards: List[Card]) -> List[CardWithHTML
 
     return cards_with_html
 
-def clean_card_content(html_content: str, author: str) -> str:
-    soup = BeautifulSoup(html_content, 'html.parser')
-
+def clean_card_content(content: HtmlElement, author: str) -> Tuple[str, str]:
+    """Trim anything before the author line of a card, returning its HTML and plain text."""
     # Find the first occurrence of the author name
-    author_elem = soup.find(string=re.compile(re.escape(author)))
-    if author_elem and author_elem.parent:
-        # Remove any preceding siblings
-        for elem in list(author_elem.parent.previous_siblings):
-            elem.decompose()
-
-        # Remove duplication in the first element
-        first_elem = author_elem.parent
-        text = first_elem.get_text()
-        parts = text.split(author)
-        if len(parts) > 2:
-            new_text = author + ''.join(parts[2:])
-            first_elem.string = new_text
-
-    return str(soup)
-
-def process_document(file_path: str, output_dir: str) -> None:
-    """Process document and save results with HTML content."""
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Extract formatted text
-    html_content = extract_formatted_text(file_path)
-    print(f"Extracted HTML content length: {len(html_content)} characters")
-
-    # Identify card boundaries
-    cards = identify_card_boundaries(html_content)
-    print(f"Identified {len(cards)} cards")
-
+    author_texts = AUTHOR_XPATH(content, author=author)
+    if author_texts:
+        author_text = author_texts[0]
+        first_elem = author_text.getparent()
+        if author_text.is_tail:
+            first_elem = first_elem.getparent()
+
+        if first_elem is not None and first_elem is not content:
+            # Remove any preceding siblings
+            for elem in list(first_elem.itersiblings(preceding=True)):
+                elem.getparent().remove(elem)
+            first_elem.getparent().text = None
+
+            # Remove duplication in the first element
+            text = first_elem.text_content()
+            parts = text.split(author)
+            if len(parts) > 2:
+                for child in list(first_elem):
+                    first_elem.remove(child)
+                first_elem.text = author + ''.join(parts[2:])
+
+    return inner_html(content), ' '.join(content.itertext())
+
+def write_cards(index: ParagraphIndex, cards: List[Card], output_dir: str) -> List[CardUpload]:
+    """Extract each card's HTML and save the results, returning the cards to upload."""
     for i, card in enumerate(cards):
         print(f"Card {i+1}:")
         print(f"  Author: {card['author']}")
@@ -272,38 +738,141 @@ def process_document(file_path: str, output_dir: str) -> None:
         print(f"  End: {card['end']}")
 
     # Extract HTML content for each card
-    cards_with_html = extract_card_html(html_content, cards)
+    cards_with_html = extract_card_html(index, cards)
     print(f"Processed document. Found {len(cards_with_html)} cards with HTML content.")
 
-    # Write cards to individual HTML files
-    for i, card in enumerate(cards_with_html):
-        cleaned_content = clean_card_content(card['html_content'], card['author'])
-        file_name = f"{card['author'].replace(' ', '_')}_{i+1}.html"
-        output_path = os.path.join(output_dir, file_name)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(f"<html><body>{cleaned_content}</body></html>")
-        print(f"Created HTML file: {file_name}")
-        res = requests.post(f"{API_BASE}/cards", json={
+    uploads: List[CardUpload] = []
+    for card in cards_with_html:
+        cleaned_content, text = clean_card_content(card['content'], card['author'])
+        uploads.append({
             'html': f"<html><body>{cleaned_content}</body></html>",
-            'text': BeautifulSoup(cleaned_content, 'html.parser').get_text(" "),
+            'text': text,
             'author': card['author'],
             'url': card['url']
         })
-
-    # Write metadata to JSON file
     metadata: List[MetadataEntry] = [{'author': card['author'], 'url': card['url']} for card in cards_with_html]
-    json_path = os.path.join(output_dir, 'metadata.json')
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2)
-    print(f"Created metadata file: metadata.json")
+
+    with output_lock:
+        # Write cards to individual HTML files
+        for i, upload in enumerate(uploads):
+            file_name = f"{upload['author'].replace(' ', '_')}_{i+1}.html"
+            output_path = os.path.join(output_dir, file_name)
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(upload['html'])
+            print(f"Created HTML file: {file_name}")
+
+        # Write metadata to JSON file
+        json_path = os.path.join(output_dir, 'metadata.json')
+        with open(json_path, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+        print(f"Created metadata file: metadata.json")
+
+    return uploads
+
+async def process_html(
+    html_content: str,
+    output_dir: str,
+    semaphore: asyncio.Semaphore,
+    http: httpx.AsyncClient
+) -> None:
+    """Identify cards in extracted HTML content and save the results."""
+    print(f"Extracted HTML content length: {len(html_content)} characters")
+
+    # Parse once and share the tree between the API request and card extraction
+    tree = parse_html(html_content)
+    text = tree.text_content()
+
+    # Build the paragraph index while the response is being generated
+    index_task = asyncio.create_task(asyncio.to_thread(ParagraphIndex, tree))
+
+    # Identify card boundaries
+    cards = await identify_card_boundaries(text, semaphore, index=index_task)
+    print(f"Identified {len(cards)} cards")
+    index = await index_task
+
+    # Keep the blocking parse and file work off the event loop
+    uploads = await asyncio.to_thread(write_cards, index, cards, output_dir)
+
+    # Upload every card concurrently rather than one round trip at a time
+    await asyncio.gather(*[http.post(f"{API_BASE}/cards", json=upload) for upload in uploads])
+    print(f"Uploaded {len(uploads)} cards")
+
+def process_document(file_path: str, output_dir: str) -> None:
+    """Process document and save results with HTML content."""
+    os.makedirs(output_dir, exist_ok=True)
+    asyncio.run(process_files([file_path], output_dir))
+
+async def process_files(file_paths: List[str], output_dir: str) -> None:
+    """Extract files across all cores, sending each to the Anthropic API as soon as it's ready."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    documents = asyncio.Semaphore(MAX_IN_FLIGHT_DOCUMENTS)
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=MAX_UPLOAD_CONNECTIONS), timeout=httpx.Timeout(UPLOAD_TIMEOUT, pool=None)) as http:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            async def process_file(file_path: str) -> None:
+                async with documents:
+                    try:
+                        html_content = await loop.run_in_executor(executor, extract_formatted_text, file_path)
+                        print(f"Extracted file: {file_path}")
+                        await process_html(html_content, output_dir, semaphore, http)
+                    except Exception as e:
+                        print(f"Error processing file: {file_path}")
+                        print(f"Error details: {str(e)}")
+
+            await asyncio.gather(*[process_file(file_path) for file_path in file_paths])
+
+def find_documents(directory: str) -> Iterator[str]:
+    """Recursively yield the paths of all .docx and .pdf files in a directory."""
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        print(f"Error reading directory: {directory}")
+        print(f"Error details: {str(e)}")
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_documents(entry.path)
+            # Like os.walk, symlinks to directories are neither followed nor yielded
+            elif not entry.is_dir():
+                _, dot, suffix = entry.name.rpartition('.')
+                if dot and suffix.lower() in DOCUMENT_SUFFIXES:
+                    yield entry.path
+
+def hash_file(file_path: str) -> str | None:
+    """Hash a file's raw bytes, or return None if it can't be read."""
+    try:
+        with open(file_path, 'rb') as f:
+            return hashlib.file_digest(f, 'blake2b').hexdigest()
+    except OSError as e:
+        print(f"Error processing file: {file_path}")
+        print(f"Error details: {str(e)}")
+        return None
+
+def deduplicate_documents(file_paths: List[str]) -> List[str]:
+    """Drop every unreadable file and every file whose contents are identical to an earlier file."""
+    # hashlib releases the GIL while hashing, so files are read and hashed in parallel
+    with ThreadPoolExecutor() as executor:
+        digests = list(executor.map(hash_file, file_paths))
+
+    unique_paths: Dict[str, str] = {}
+    for file_path, digest in zip(file_paths, digests):
+        if digest is None:
+            continue
+        if digest in unique_paths:
+            print(f"Skipping duplicate of {unique_paths[digest]}: {file_path}")
+        else:
+            unique_paths[digest] = file_path
+
+    return list(unique_paths.values())
 
 def process_directory(input_dir: str, output_dir: str) -> None:
     """Process all .docx and .pdf files in the directory and its subdirectories."""
     os.makedirs(output_dir, exist_ok=True)
 
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file.lower().endswith(('.docx', '.pdf')):
-                file_path = os.path.join(root, file)
-                print(f"Processing file: {file_path}")
-                process_document(file_path, output_dir)
+    file_paths = deduplicate_documents(list(find_documents(input_dir)))
+
+    print(f"Processing {len(file_paths)} files")
+    asyncio.run(process_files(file_paths, output_dir))